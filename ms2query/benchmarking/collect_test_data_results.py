@@ -3,12 +3,13 @@ This script is not needed for running MS2Query, instead it was used to generate
 test results for benchmarking MS2Query against other tools.
 """
 
+import hashlib
 import os
-import random
-import sqlite3
-import tempfile
 from typing import List, Tuple, Union
+import numpy as np
 import pandas as pd
+import tensorflow as tf
+from joblib import Parallel, delayed
 from matchms import Spectrum
 from matchms.calculate_scores import calculate_scores
 from matchms.similarity.CosineGreedy import CosineGreedy
@@ -20,40 +21,100 @@ from tqdm import tqdm
 from ms2query.create_new_library.calculate_tanimoto_scores import (
     calculate_highest_tanimoto_score, calculate_single_tanimoto_score)
 from ms2query.ms2library import MS2Library
-from ms2query.query_from_sqlite_database import SqliteLibrary
-from ms2query.utils import save_json_file
+from ms2query.query_from_sqlite_database import (SqliteLibrary,
+                                                 _sqlite_connection)
+from ms2query.utils import (load_pickled_file, normalize_embeddings,
+                            save_json_file, save_pickled_file)
+
+
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+
+def get_inchikeys14(spectra: List[Spectrum]) -> np.ndarray:
+    """Returns the 14 character inchikey prefix for each spectrum
+
+    Precomputing the prefixes once avoids repeating the metadata lookup and
+    string slicing for every comparison in the loops below.
+    """
+    return np.array([spectrum.get("inchikey")[:14] for spectrum in spectra])
 
 
 def generate_test_results_ms2query(ms2library: MS2Library,
                                    test_spectra: List[Spectrum]
                                    ) -> List[Tuple[float, float, bool]]:
     # pylint:disable=too-many-locals
-    # Create a temporary directory for the csv results
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        temporary_file_csv_results = os.path.join(tmpdirname, "temporary_csv_file.csv")
-        ms2library.analog_search_store_in_csv(test_spectra,
-                                              results_csv_file_location=temporary_file_csv_results)
-        df_results_ms2query = pd.read_csv(temporary_file_csv_results)
+    df_results_ms2query = ms2library.analog_search_return_df(test_spectra)
 
+    # Group the results once per query spectrum nr instead of rescanning the
+    # full dataframe for every test spectrum
+    results_per_query_nr = dict(tuple(df_results_ms2query.groupby("query_spectrum_nr")))
+
+    test_inchikeys14 = get_inchikeys14(test_spectra)
     test_results_ms2query = []
     for i, test_spectrum in enumerate(test_spectra):
-        query_spectrum_id = i + 1
-        annotated = False
-        for inchikey, smiles, ms2query_model_prediction, query_spectrum_id_in_df in df_results_ms2query[
-            ["inchikey", "smiles", "ms2query_model_prediction", "query_spectrum_nr"]].to_numpy():
-            if query_spectrum_id == query_spectrum_id_in_df:
-                tanimoto_score = calculate_single_tanimoto_score(test_spectrum.get("smiles"), smiles)
-                exact_match = inchikey == test_spectrum.get("inchikey")[:14]
-                test_results_ms2query.append((ms2query_model_prediction, tanimoto_score, exact_match))
-                annotated = True
-        if not annotated:
+        results_for_spectrum = results_per_query_nr.get(i + 1)
+        if results_for_spectrum is None:
             test_results_ms2query.append(None)
+            continue
+        exact_matches = results_for_spectrum["inchikey"].to_numpy() == test_inchikeys14[i]
+        tanimoto_scores = [calculate_single_tanimoto_score(test_spectrum.get("smiles"), smiles)
+                           for smiles in results_for_spectrum["smiles"]]
+        test_results_ms2query.extend(zip(results_for_spectrum["ms2query_model_prediction"].tolist(),
+                                         tanimoto_scores,
+                                         exact_matches.tolist()))
     return test_results_ms2query
 
 
+def align_array(array: np.ndarray, alignment: int = 64) -> np.ndarray:
+    """Returns a contiguous copy of array starting on an alignment byte boundary
+
+    numpy only guarantees itemsize alignment; starting the data on a cache
+    line boundary lets the SIMD cosine kernel use aligned loads without
+    cache line splits.
+    """
+    buffer = np.empty(array.size + alignment // array.itemsize, dtype=array.dtype)
+    offset = (-buffer.ctypes.data) % alignment // array.itemsize
+    aligned_copy = buffer[offset:offset + array.size].reshape(array.shape)
+    aligned_copy[:] = array
+    return aligned_copy
+
+
+def cosine_similarity_matrix_gpu(library_embeddings: np.ndarray,
+                                 query_embeddings: np.ndarray,
+                                 query_batch_size: int = 1024) -> np.ndarray:
+    """Calculates the cosine similarity matrix on the GPU with tensorflow
+
+    The queries are processed in batches to bound the GPU memory usage.
+    """
+    library_tensor = tf.math.l2_normalize(
+        tf.convert_to_tensor(library_embeddings, dtype=tf.float32), axis=1)
+    score_blocks = []
+    for batch_start in range(0, len(query_embeddings), query_batch_size):
+        query_batch = tf.math.l2_normalize(
+            tf.convert_to_tensor(query_embeddings[batch_start:batch_start + query_batch_size],
+                                 dtype=tf.float32), axis=1)
+        score_blocks.append(tf.matmul(library_tensor, query_batch, transpose_b=True).numpy())
+    return np.concatenate(score_blocks, axis=1)
+
+
+def quantize_embeddings_to_int8(embeddings: np.ndarray) -> np.ndarray:
+    """Quantizes embeddings to int8 with a per row scale
+
+    Cosine similarity is invariant to the scale of each row, so the quantized
+    embeddings can be used directly in the cosine similarity calculation.
+    """
+    scales = np.abs(embeddings).max(axis=1)
+    scales[scales == 0] = 1
+    return np.round(embeddings / scales[:, None] * 127).astype(np.int8)
+
+
 def get_all_ms2ds_scores(ms2ds_model: SiameseModel,
                          ms2ds_embeddings,
-                         test_spectra
+                         test_spectra,
+                         quantize_to_int8: bool = False
                          ) -> pd.DataFrame:
     """Returns a dataframe with the ms2deepscore similarity scores
 
@@ -63,14 +124,48 @@ def get_all_ms2ds_scores(ms2ds_model: SiameseModel,
     query_spectra
         Spectra for which similarity scores should be calculated for all
         spectra in the ms2ds embeddings file.
+    quantize_to_int8
+        If True the embeddings are quantized to int8 before the similarity
+        calculation. This reduces memory bandwidth at the cost of a small
+        loss in score precision. Default = False
     """
     # ms2ds_model = load_ms2ds_model(ms2ds_model_file_name)
     ms2ds = MS2DeepScore(ms2ds_model, progress_bar=False)
     query_embeddings = ms2ds.calculate_vectors(test_spectra)
     library_ms2ds_embeddings_numpy = ms2ds_embeddings.to_numpy()
 
-    ms2ds_scores = cosine_similarity_matrix(library_ms2ds_embeddings_numpy,
-                                            query_embeddings)
+    if quantize_to_int8:
+        library_ms2ds_embeddings_numpy = quantize_embeddings_to_int8(library_ms2ds_embeddings_numpy)
+        query_embeddings = quantize_embeddings_to_int8(query_embeddings)
+    else:
+        # Normalizing both sides once saves a norm calculation per library
+        # query pair, since the cosine becomes a plain dot product.
+        library_ms2ds_embeddings_numpy = normalize_embeddings(library_ms2ds_embeddings_numpy)
+        query_embeddings = normalize_embeddings(query_embeddings)
+
+    if len(tf.config.list_physical_devices("GPU")) > 0:
+        ms2ds_scores = cosine_similarity_matrix_gpu(library_ms2ds_embeddings_numpy,
+                                                    query_embeddings)
+    elif simsimd is not None:
+        if quantize_to_int8:
+            # The SIMD accelerated kernel returns cosine distances instead of similarities
+            ms2ds_scores = 1 - np.asarray(
+                simsimd.cdist(align_array(library_ms2ds_embeddings_numpy),
+                              align_array(query_embeddings),
+                              metric="cosine"))
+        else:
+            ms2ds_scores = np.asarray(
+                simsimd.cdist(align_array(library_ms2ds_embeddings_numpy),
+                              align_array(query_embeddings),
+                              metric="dot"))
+    else:
+        if quantize_to_int8:
+            # cosine_similarity_matrix expects floats, so quantized embeddings are cast back
+            ms2ds_scores = cosine_similarity_matrix(
+                library_ms2ds_embeddings_numpy.astype(np.float32),
+                query_embeddings.astype(np.float32))
+        else:
+            ms2ds_scores = library_ms2ds_embeddings_numpy @ query_embeddings.T
     similarity_matrix_dataframe = pd.DataFrame(
         ms2ds_scores,
         index=ms2ds_embeddings.index)
@@ -81,28 +176,45 @@ def select_highest_ms2ds_in_mass_range(ms2deepscores,
                                        test_spectra,
                                        sqlite_library: SqliteLibrary,
                                        allowed_mass_diff: Union[None, float]) -> List[Tuple[float, float, bool]]:
+    # pylint:disable=too-many-locals
+    library_spectrum_ids = np.array(ms2deepscores.index)
+    # The score matrix is accessed column wise (one column per test spectrum),
+    # so a column-major layout keeps each mass window scan cache friendly
+    scores = np.asfortranarray(ms2deepscores.to_numpy())
+    if allowed_mass_diff is not None:
+        # Load the library precursor mz's once and select the highest scoring
+        # spectrum within the mass range for all test spectra in one vectorized pass
+        precursor_mz_library = sqlite_library.get_precursor_mz()
+        library_mz = np.array([precursor_mz_library[spectrum_id] for spectrum_id in library_spectrum_ids])
+        query_mz = np.array([test_spectrum.get("precursor_mz") for test_spectrum in test_spectra])
+        within_mass_range = np.abs(library_mz[:, None] - query_mz[None, :]) <= allowed_mass_diff
+        indexes_highest_scores = np.where(within_mass_range, scores, -np.inf).argmax(axis=0)
+        selected_row_indexes = [index if within_mass_range[:, i].any() else None
+                                for i, index in enumerate(indexes_highest_scores)]
+    else:
+        selected_row_indexes = list(scores.argmax(axis=0))
+    # Keep integer row indexes so scores can be gathered from the numpy array
+    # directly, instead of going through a pandas label lookup per result
+    selected_spectrum_ids = [library_spectrum_ids[row_index] if row_index is not None else None
+                             for row_index in selected_row_indexes]
+
+    # Get the metadata for all selected spectrum ids with a single batched query
+    unique_selected_ids = list({spectrum_id for spectrum_id in selected_spectrum_ids
+                                if spectrum_id is not None})
+    if len(unique_selected_ids) > 0:
+        lib_metadata_dict = sqlite_library.get_metadata_from_sqlite(unique_selected_ids)
+    else:
+        lib_metadata_dict = {}
+
+    test_inchikeys14 = get_inchikeys14(test_spectra)
     results_ms2deepscore = []
-    for i, test_spectrum in tqdm(enumerate(test_spectra)):
-        precursor_mz_query_spectrum = test_spectrum.get("precursor_mz")
-        if allowed_mass_diff is not None:
-            spectrum_ids_and_mass = get_precursor_mz_within_range(
-                sqlite_library.sqlite_file_name,
-                precursor_mz_query_spectrum - allowed_mass_diff,
-                precursor_mz_query_spectrum + allowed_mass_diff)
-            spectrum_ids = [spectrum_and_mass[0] for spectrum_and_mass in spectrum_ids_and_mass]
-            if len(spectrum_ids) == 0:
-                spectrum_id_highest_ms2_deepscore_in_mass_range = None
-            else:
-                spectrum_id_highest_ms2_deepscore_in_mass_range = ms2deepscores[i].loc[spectrum_ids].idxmax()
-        else:
-            spectrum_id_highest_ms2_deepscore_in_mass_range = ms2deepscores[i].idxmax()
+    for i, test_spectrum in enumerate(test_spectra):
+        spectrum_id_highest_ms2_deepscore_in_mass_range = selected_spectrum_ids[i]
         if spectrum_id_highest_ms2_deepscore_in_mass_range is not None:
-            # Get metadata belonging to spectra ids
-            lib_metadata = sqlite_library.get_metadata_from_sqlite(
-                [spectrum_id_highest_ms2_deepscore_in_mass_range])[spectrum_id_highest_ms2_deepscore_in_mass_range]
+            lib_metadata = lib_metadata_dict[spectrum_id_highest_ms2_deepscore_in_mass_range]
             tanimoto_score = calculate_single_tanimoto_score(test_spectrum.get("smiles"), lib_metadata["smiles"])
-            exact_match = lib_metadata["inchikey"][:14] == test_spectrum.get("inchikey")[:14]
-            results_ms2deepscore.append((float(ms2deepscores[i][spectrum_id_highest_ms2_deepscore_in_mass_range]),
+            exact_match = lib_metadata["inchikey"][:14] == test_inchikeys14[i]
+            results_ms2deepscore.append((float(scores[selected_row_indexes[i], i]),
                                          tanimoto_score,
                                          exact_match))
         else:
@@ -110,12 +222,21 @@ def select_highest_ms2ds_in_mass_range(ms2deepscores,
     return results_ms2deepscore
 
 
+# Cache with per sqlite file the spectrum ids and precursor mz's sorted on precursor mz,
+# so repeated range queries do not have to rescan the sqlite table.
+_sorted_precursor_mz_cache = {}
+
+
 def get_precursor_mz_within_range(sqlite_file_name: str,
                                   lower_bound: Union[float, int],
                                   upper_bound: Union[float, int],
-                                  ) -> List[Tuple[str, float]]:
+                                  ) -> List[str]:
     """Returns spectrum_ids with precursor m/z between lower and upper bound
 
+    The precursor m/z column is loaded from sqlite once per file and cached as
+    sorted numpy arrays, so each range query is a binary search instead of a
+    table scan.
+
     Args:
     -----
     sqlite_file_name:
@@ -125,48 +246,56 @@ def get_precursor_mz_within_range(sqlite_file_name: str,
     upper_bound:
         The upper bound of the allowed precursor m/z
     """
-    conn = sqlite3.connect(sqlite_file_name)
-    sqlite_command = \
-        f"""SELECT spectrumid, precursor_mz FROM spectrum_data 
-        WHERE precursor_mz BETWEEN {lower_bound} and {upper_bound}"""
-    cur = conn.cursor()
-    cur.execute(sqlite_command)
-    spectrum_ids_within_range = cur.fetchall()
-    return spectrum_ids_within_range
+    if sqlite_file_name not in _sorted_precursor_mz_cache:
+        cur = _sqlite_connection(sqlite_file_name).cursor()
+        cur.execute("SELECT spectrumid, precursor_mz FROM spectrum_data ORDER BY precursor_mz")
+        results = cur.fetchall()
+        spectrum_ids = np.array([result[0] for result in results])
+        precursor_mzs = np.array([result[1] for result in results])
+        _sorted_precursor_mz_cache[sqlite_file_name] = (spectrum_ids, precursor_mzs)
+    spectrum_ids, precursor_mzs = _sorted_precursor_mz_cache[sqlite_file_name]
+    # Both bounds are inclusive, like the sqlite BETWEEN that was used before
+    lower_index = np.searchsorted(precursor_mzs, lower_bound, side="left")
+    upper_index = np.searchsorted(precursor_mzs, upper_bound, side="right")
+    # Only the spectrum ids are returned, since no caller needs the
+    # precursor mz's and pairing them up would just be extra tuple building.
+    return spectrum_ids[lower_index:upper_index].tolist()
 
 
 def select_spectra_within_mass_range(spectra, lower_bound, upper_bound):
-    selected_spectra = []
-    for spectrum in spectra:
-        precursor_mz = spectrum.get('precursor_mz')
-        if upper_bound >= precursor_mz >= lower_bound:
-            selected_spectra.append(spectrum)
-    return selected_spectra
+    precursor_mzs = np.fromiter((spectrum.get('precursor_mz') for spectrum in spectra),
+                                dtype=np.float64, count=len(spectra))
+    within_range = (precursor_mzs >= lower_bound) & (precursor_mzs <= upper_bound)
+    return [spectra[i] for i in np.flatnonzero(within_range)]
 
 
 def get_modified_cosine_score_results(lib_spectra,
                                       test_spectra,
                                       mass_tolerance=100) -> List[Tuple[float, float, bool]]:
+    # pylint:disable=too-many-locals
+    # Calculate all pairs in one batched call, the mass window is applied afterwards
+    all_scores = calculate_scores(lib_spectra, test_spectra, ModifiedCosine())
+    library_mz = np.fromiter((spectrum.get("precursor_mz") for spectrum in lib_spectra),
+                             dtype=np.float64, count=len(lib_spectra))
+    test_inchikeys14 = get_inchikeys14(test_spectra)
     best_matches_for_test_spectra = []
-    for test_spectrum in tqdm(test_spectra):
+    for test_nr, test_spectrum in enumerate(tqdm(test_spectra)):
         precursor_mz = test_spectrum.get("precursor_mz")
+        scores_list = all_scores.scores_by_query(test_spectrum)
         if mass_tolerance is not None:
-            selected_lib_spectra = select_spectra_within_mass_range(lib_spectra,
-                                                                    precursor_mz-mass_tolerance,
-                                                                    precursor_mz+mass_tolerance)
-        else:
-            selected_lib_spectra = lib_spectra
-        if len(selected_lib_spectra) != 0:
-            scores_list = calculate_scores(selected_lib_spectra,
-                                           [test_spectrum], ModifiedCosine()).scores_by_query(test_spectrum)
+            within_mass_range = np.abs(library_mz - precursor_mz) <= mass_tolerance
+            scores_list = [scores_list[i] for i in np.flatnonzero(within_mass_range)]
+        if len(scores_list) != 0:
             # Scores list is a List[spectrum, (mod_cos, matching_peaks)
-            cosine_scores = [scores_tuple[1]["score"] for scores_tuple in scores_list]
-            highest_cosine_score = float(max(cosine_scores))
-            highest_scoring_spectrum = scores_list[cosine_scores.index(highest_cosine_score)][0]
+            cosine_scores = np.fromiter((scores_tuple[1]["score"] for scores_tuple in scores_list),
+                                        dtype=np.float64, count=len(scores_list))
+            index_highest_score = int(cosine_scores.argmax())
+            highest_cosine_score = float(cosine_scores[index_highest_score])
+            highest_scoring_spectrum = scores_list[index_highest_score][0]
 
             tanimoto_score = calculate_single_tanimoto_score(test_spectrum.get("smiles"),
                                                              highest_scoring_spectrum.get("smiles"))
-            exact_match = highest_scoring_spectrum.get("inchikey")[:14] == test_spectrum.get("inchikey")[:14]
+            exact_match = highest_scoring_spectrum.get("inchikey")[:14] == test_inchikeys14[test_nr]
             best_matches_for_test_spectra.append((highest_cosine_score, tanimoto_score, exact_match))
         else:
             best_matches_for_test_spectra.append(None)
@@ -178,25 +307,34 @@ def get_cosines_score_results(lib_spectra,
                               mass_tolerance,
                               fragment_mass_tolerance,
                               minimum_matched_peaks):
+    # pylint:disable=too-many-locals
+    # Calculate all pairs in one batched call, the mass window is applied afterwards
+    all_scores = calculate_scores(lib_spectra, test_spectra,
+                                  CosineGreedy(tolerance=fragment_mass_tolerance))
+    library_mz = np.fromiter((spectrum.get("precursor_mz") for spectrum in lib_spectra),
+                             dtype=np.float64, count=len(lib_spectra))
+    test_inchikeys14 = get_inchikeys14(test_spectra)
     best_matches_for_test_spectra = []
-    for test_spectrum in tqdm(test_spectra):
+    for test_nr, test_spectrum in enumerate(tqdm(test_spectra)):
         precursor_mz = test_spectrum.get("precursor_mz")
+        scores_list = all_scores.scores_by_query(test_spectrum)
         if mass_tolerance is not None:
-            selected_lib_spectra = select_spectra_within_mass_range(lib_spectra, precursor_mz-mass_tolerance, precursor_mz+mass_tolerance)
-        else:
-            selected_lib_spectra = lib_spectra
-        if len(selected_lib_spectra) != 0:
-            scores_list = calculate_scores(selected_lib_spectra,
-                                           [test_spectrum],
-                                           CosineGreedy(tolerance=fragment_mass_tolerance)).scores_by_query(test_spectrum)
-            cosine_scores = [scores_tuple[1].item()[0] for scores_tuple in scores_list if scores_tuple[1].item()[1] >= minimum_matched_peaks]
-            if len(cosine_scores) != 0:
-                highest_cosine_score = max(cosine_scores)
-                highest_scoring_spectrum = scores_list[cosine_scores.index(highest_cosine_score)][0]
+            within_mass_range = np.abs(library_mz - precursor_mz) <= mass_tolerance
+            scores_list = [scores_list[i] for i in np.flatnonzero(within_mass_range)]
+        if len(scores_list) != 0:
+            scores_and_matches = np.array([scores_tuple[1].item() for scores_tuple in scores_list])
+            # Scores with too few matching peaks are masked out, which keeps the
+            # indexes aligned with scores_list
+            cosine_scores = np.where(scores_and_matches[:, 1] >= minimum_matched_peaks,
+                                     scores_and_matches[:, 0], -np.inf)
+            if np.isfinite(cosine_scores).any():
+                index_highest_score = int(cosine_scores.argmax())
+                highest_cosine_score = float(cosine_scores[index_highest_score])
+                highest_scoring_spectrum = scores_list[index_highest_score][0]
 
                 tanimoto_score = calculate_single_tanimoto_score(test_spectrum.get("smiles"),
                                                                  highest_scoring_spectrum.get("smiles"))
-                exact_match = highest_scoring_spectrum.get("inchikey")[:14] == test_spectrum.get("inchikey")[:14]
+                exact_match = highest_scoring_spectrum.get("inchikey")[:14] == test_inchikeys14[test_nr]
                 best_matches_for_test_spectra.append((highest_cosine_score, tanimoto_score, exact_match))
             else:
                 best_matches_for_test_spectra.append(None)
@@ -205,27 +343,57 @@ def get_cosines_score_results(lib_spectra,
     return best_matches_for_test_spectra
 
 
-def create_optimal_results(test_spectra, training_spectra):
-    highest_tanimoto_scores = calculate_highest_tanimoto_score(test_spectra, training_spectra, 1)
+def create_optimal_results(test_spectra, training_spectra,
+                           cache_dir: Union[str, None] = None):
+    """Returns the highest possible tanimoto score for each test spectrum
 
-    highest_tanimoto_list = []
-    for spectrum in test_spectra:
-        inchikey = spectrum.get("inchikey")[:14]
-        highest_tanimoto_score = highest_tanimoto_scores[inchikey][0][1]
-        exact_match = inchikey == highest_tanimoto_scores[inchikey][0][0]
-        highest_tanimoto_list.append((highest_tanimoto_score, highest_tanimoto_score, exact_match))
-    return highest_tanimoto_list
+    cache_dir:
+        Directory in which the highest tanimoto scores are cached on disk.
+        Calculating the pairwise fingerprints is the most expensive step of
+        the benchmark, so rerunning with the same spectra reuses the cached
+        scores. Default = None, meaning no caching.
+    """
+    highest_tanimoto_scores = None
+    cache_file_name = None
+    if cache_dir is not None:
+        # The hash covers both spectrum sets, since the highest scores depend
+        # on the test inchikeys as well as the training smiles
+        smiles_hash = hashlib.md5(
+            ("".join(sorted(spectrum.get("smiles") for spectrum in test_spectra)) + "_" +
+             "".join(sorted(spectrum.get("smiles") for spectrum in training_spectra))).encode()).hexdigest()
+        cache_file_name = os.path.join(cache_dir, f"highest_tanimoto_scores_{smiles_hash}.pickle")
+        if os.path.isfile(cache_file_name):
+            highest_tanimoto_scores = load_pickled_file(cache_file_name)
+    if highest_tanimoto_scores is None:
+        highest_tanimoto_scores = calculate_highest_tanimoto_score(test_spectra, training_spectra, 1)
+        if cache_file_name is not None:
+            save_pickled_file(highest_tanimoto_scores, cache_file_name)
+
+    # The best match per unique inchikey is looked up once and broadcast over
+    # the test spectra with pandas, instead of two dict lookups per spectrum
+    test_inchikeys14 = get_inchikeys14(test_spectra)
+    best_inchikeys = pd.Series({inchikey: matches[0][0]
+                                for inchikey, matches in highest_tanimoto_scores.items()})
+    best_scores = pd.Series({inchikey: matches[0][1]
+                             for inchikey, matches in highest_tanimoto_scores.items()})
+    scores_per_spectrum = best_scores[test_inchikeys14].to_numpy(dtype=float).tolist()
+    exact_matches = (best_inchikeys[test_inchikeys14].to_numpy() == test_inchikeys14).tolist()
+    return list(zip(scores_per_spectrum, scores_per_spectrum, exact_matches))
 
 
 def create_random_results(test_spectra: List[Spectrum],
                           training_spectra: List[Spectrum]) -> List[Tuple[float, float, bool]]:
-    random_predictions = []
-    for test_spectrum in test_spectra:
-        random_lib_spectrum = random.choice(training_spectra)
-        tanimoto_score = calculate_single_tanimoto_score(test_spectrum.get("smiles"), random_lib_spectrum.get("smiles"))
-        exact_match = random_lib_spectrum.get("inchikey")[:14] == test_spectrum.get("inchikey")[:14]
-        random_predictions.append((random.random(), tanimoto_score, exact_match))
-    return random_predictions
+    # All random draws are done in two bulk calls instead of one call per
+    # test spectrum
+    random_lib_spectra = [training_spectra[i] for i in
+                          np.random.randint(0, len(training_spectra), size=len(test_spectra))]
+    random_scores = np.random.random(size=len(test_spectra)).tolist()
+    # The fingerprints are cached, so only the jaccard index is recalculated per pair
+    tanimoto_scores = [calculate_single_tanimoto_score(test_spectrum.get("smiles"),
+                                                       lib_spectrum.get("smiles"))
+                       for test_spectrum, lib_spectrum in zip(test_spectra, random_lib_spectra)]
+    exact_matches = (get_inchikeys14(random_lib_spectra) == get_inchikeys14(test_spectra)).tolist()
+    return list(zip(random_scores, tanimoto_scores, exact_matches))
 
 
 def generate_test_results(ms2library: MS2Library,
@@ -236,7 +404,6 @@ def generate_test_results(ms2library: MS2Library,
     in the format [lib_spec_id_highest_score, predicted_score, test_spectrum]
 """
     # pylint:disable=too-many-locals
-    # pylint:disable=too-many-branches
     assert ms2library.ms2ds_embeddings.shape[0] == len(training_spectra), \
         "The number of spectra in the library is not equal to the number of training spectra"
 
@@ -244,73 +411,63 @@ def generate_test_results(ms2library: MS2Library,
         os.mkdir(output_dir)
 
     ms2query_results_file_name = os.path.join(output_dir, "ms2query_test_results.json")
-    if not os.path.isfile(ms2query_results_file_name):
-        # Generate MS2Query results
-        ms2query_test_results = generate_test_results_ms2query(ms2library, test_spectra)
-        save_json_file(ms2query_test_results, ms2query_results_file_name)
-    else:
-        print(f"File already exists so not remade: {ms2query_results_file_name}")
-
     ms2ds_results_100_file_name = os.path.join(output_dir, "ms2deepscore_test_results_100_Da.json")
     ms2ds_results_all_file_name = os.path.join(output_dir, "ms2deepscore_test_results_all.json")
+    modified_cosine_score_file_name = os.path.join(output_dir, "modified_cosine_score_100_Da_test_results.json")
+    cosine_score_file_name = os.path.join(output_dir, "cosine_score_100_da_test_results.json")
+    optimal_results_file_name = os.path.join(output_dir, "optimal_results.json")
+    random_results_file_name = os.path.join(output_dir, "random_results.json")
 
-    if not os.path.isfile(ms2ds_results_100_file_name) or not os.path.join(ms2ds_results_all_file_name):
-        # Generate MS2Deepscore results
+    # The results for each tool only depend on read-only inputs, so they can
+    # be generated in parallel.
+    tasks = [(ms2query_results_file_name,
+              lambda: generate_test_results_ms2query(ms2library, test_spectra))]
+
+    if not os.path.isfile(ms2ds_results_100_file_name) or not os.path.isfile(ms2ds_results_all_file_name):
+        # The ms2ds scores are shared by the two selections below and are
+        # calculated up front, since the model is not thread safe.
         ms2ds_scores = get_all_ms2ds_scores(ms2library.ms2ds_model,
                                             ms2library.ms2ds_embeddings,
                                             test_spectra)
-        if not os.path.isfile(ms2ds_results_100_file_name):
-            ms2ds_test_results_mass_diff_100 = select_highest_ms2ds_in_mass_range(ms2ds_scores,
-                                                                                  test_spectra,
-                                                                                  ms2library.sqlite_library,
-                                                                                  allowed_mass_diff=100)
-            save_json_file(ms2ds_test_results_mass_diff_100, ms2ds_results_100_file_name)
-        else:
-            print(f"File already exists so not remade: {ms2ds_results_100_file_name}")
-
-        if not os.path.isfile(ms2ds_results_all_file_name):
-            ms2ds_test_results_all = select_highest_ms2ds_in_mass_range(ms2ds_scores,
-                                                                        test_spectra,
-                                                                        ms2library.sqlite_library,
-                                                                        allowed_mass_diff=None)
-            save_json_file(ms2ds_test_results_all, ms2ds_results_all_file_name)
-        else:
-            print(f"File already exists so not remade: {ms2ds_results_all_file_name}")
+        tasks.append((ms2ds_results_100_file_name,
+                      lambda: select_highest_ms2ds_in_mass_range(ms2ds_scores,
+                                                                 test_spectra,
+                                                                 ms2library.sqlite_library,
+                                                                 allowed_mass_diff=100)))
+        tasks.append((ms2ds_results_all_file_name,
+                      lambda: select_highest_ms2ds_in_mass_range(ms2ds_scores,
+                                                                 test_spectra,
+                                                                 ms2library.sqlite_library,
+                                                                 allowed_mass_diff=None)))
     else:
         print("MS2Deepscore files already exist")
 
-    modified_cosine_score_file_name = os.path.join(output_dir, "modified_cosine_score_100_Da_test_results.json")
-    if not os.path.isfile(modified_cosine_score_file_name):
-        # Generate Modified cosine results
-        modified_cosine_results = get_modified_cosine_score_results(training_spectra, test_spectra, mass_tolerance=100)
-        save_json_file(modified_cosine_results, modified_cosine_score_file_name)
-    else:
-        print(f"File already exists so not remade: {modified_cosine_score_file_name}")
-
-    cosine_score_file_name = os.path.join(output_dir, "cosine_score_100_da_test_results.json")
-    if not os.path.isfile(cosine_score_file_name):
-        cosine_results = get_cosines_score_results(training_spectra,
-                                                   test_spectra,
-                                                   mass_tolerance=100,
-                                                   fragment_mass_tolerance=0.05,
-                                                   minimum_matched_peaks=0)
-        save_json_file(cosine_results, cosine_score_file_name)
+    tasks.append((modified_cosine_score_file_name,
+                  lambda: get_modified_cosine_score_results(training_spectra, test_spectra, mass_tolerance=100)))
+    tasks.append((cosine_score_file_name,
+                  lambda: get_cosines_score_results(training_spectra,
+                                                    test_spectra,
+                                                    mass_tolerance=100,
+                                                    fragment_mass_tolerance=0.05,
+                                                    minimum_matched_peaks=0)))
+    tasks.append((optimal_results_file_name,
+                  lambda: create_optimal_results(test_spectra, training_spectra,
+                                                 cache_dir=output_dir)))
+    tasks.append((random_results_file_name,
+                  lambda: create_random_results(test_spectra, training_spectra)))
+
+    Parallel(n_jobs=len(tasks), backend="threading")(
+        delayed(_create_and_save_results)(results_file_name, create_results_function)
+        for results_file_name, create_results_function in tasks)
+
+
+def _create_and_save_results(results_file_name, create_results_function):
+    """Creates and stores the results for one tool, skipping already existing files"""
+    if not os.path.isfile(results_file_name):
+        results = create_results_function()
+        save_json_file(results, results_file_name)
     else:
-        print(f"File already exists so not remade: {cosine_score_file_name}")
-
-    optimal_results_file_name = os.path.join(output_dir, "optimal_results.json")
-    if not os.path.isfile(optimal_results_file_name):
-        optimal_results = create_optimal_results(test_spectra, training_spectra)
-        save_json_file(optimal_results, optimal_results_file_name)
-    else:
-        print(f"File already exists so not remade: {optimal_results_file_name}")
-
-    random_results_file_name = os.path.join(output_dir, "random_results.json")
-    if not os.path.isfile(random_results_file_name):
-        random_results = create_random_results(test_spectra, training_spectra)
-        save_json_file(random_results, random_results_file_name)
-    else:
-        print(f"File already exists so not remade: {random_results_file_name}")
+        print(f"File already exists so not remade: {results_file_name}")
 
 
 def generate_exact_matches_test_results(ms2library: MS2Library,
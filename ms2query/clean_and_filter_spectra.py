@@ -1,11 +1,14 @@
 from typing import List, Tuple
 import matchms.filtering as msfilters
+import numpy as np
+from gensim.models import Word2Vec
 from matchms import Spectrum
 from matchms.logging_functions import set_matchms_logger_level
 from matchms.metadata_utils import (is_valid_inchi, is_valid_inchikey,
                                     is_valid_smiles)
 from matchms.typing import SpectrumType
 from matchmsextras.pubchem_lookup import pubchem_metadata_lookup
+from ms2deepscore import MS2DeepScore
 from spec2vec import SpectrumDocument
 from tqdm import tqdm
 
@@ -56,6 +59,59 @@ def create_spectrum_documents(query_spectra: List[Spectrum],
     return spectrum_documents
 
 
+def calculate_ms2ds_embeddings_in_batches(ms2ds_model,
+                                          list_of_spectra: List[Spectrum],
+                                          batch_size: int = 512,
+                                          progress_bar: bool = True) -> np.ndarray:
+    """Returns the ms2ds embeddings for the spectra, predicted in batches
+
+    All spectra are binned once and the base model is run over large
+    batches, instead of one predict call per spectrum. This avoids paying
+    the keras call overhead for every single spectrum.
+    """
+    # pylint: disable=protected-access
+    ms2ds = MS2DeepScore(ms2ds_model, progress_bar=progress_bar)
+    binned_spectra = ms2ds_model.spectrum_binner.transform(list_of_spectra,
+                                                           progress_bar=progress_bar)
+    input_vectors = np.vstack([ms2ds._create_input_vector(binned_spectrum)
+                               for binned_spectrum in binned_spectra])
+    return ms2ds_model.base.predict(input_vectors, batch_size=batch_size, verbose=0)
+
+
+def calculate_s2v_embeddings_in_batches(s2v_model: Word2Vec,
+                                        spectrum_documents: List[SpectrumDocument],
+                                        batch_size: int = 5000,
+                                        progress_bar: bool = True) -> np.ndarray:
+    """Returns the s2v embeddings for the spectrum documents
+
+    With an intensity weighting power of 0, calc_vector reduces to summing
+    the word vectors of the peaks and losses known by the model. The per
+    document python calls are replaced by one gather over the word vector
+    matrix followed by a segmented sum per batch of documents.
+    """
+    key_to_index = s2v_model.wv.key_to_index
+    word_vectors = s2v_model.wv.vectors.astype(np.float64)
+    embeddings = np.zeros((len(spectrum_documents), s2v_model.wv.vector_size))
+    for batch_start in tqdm(range(0, len(spectrum_documents), batch_size),
+                            desc="Calculating embeddings",
+                            disable=not progress_bar):
+        batch = spectrum_documents[batch_start:batch_start + batch_size]
+        token_ids = []
+        tokens_per_document = []
+        for document in batch:
+            known_tokens = [key_to_index[word] for word in document.words
+                            if word in key_to_index]
+            token_ids.extend(known_tokens)
+            tokens_per_document.append(len(known_tokens))
+        # Documents without any known tokens keep an all zero embedding,
+        # like calc_vector returns for them
+        document_of_token = np.repeat(np.arange(len(batch)), tokens_per_document)
+        np.add.at(embeddings[batch_start:batch_start + batch_size],
+                  document_of_token,
+                  word_vectors[np.array(token_ids, dtype=np.intp)])
+    return embeddings
+
+
 def harmonize_annotation(spectrum: Spectrum,
                          do_pubchem_lookup) -> Spectrum:
     set_matchms_logger_level("CRITICAL")
@@ -3,6 +3,7 @@ This script is not needed for normally running MS2Query, it is only needed to ge
 new models
 """
 from collections import Counter
+from functools import lru_cache
 from typing import List
 import numpy as np
 import pandas as pd
@@ -20,23 +21,42 @@ def get_fingerprint(smiles: str):
     return fingerprint
 
 
+@lru_cache(maxsize=2**16)
+def get_fingerprint_cached(smiles: str):
+    """Returns the fingerprint for a smiles, reusing fingerprints of already seen smiles
+
+    This avoids reparsing the smiles and regenerating the fingerprint for
+    every pair when the same spectra are scored repeatedly, like in the
+    benchmarking loops.
+    """
+    return get_fingerprint(smiles)
+
+
 def calculate_tanimoto_scores_from_smiles(list_of_smiles_1: List[str],
                                           list_of_smiles_2: List[str]) -> np.ndarray:
-    """Returns a 2d ndarray containing the tanimoto scores between the smiles"""
-    fingerprints_1 = np.array([get_fingerprint(spectrum) for spectrum in tqdm(list_of_smiles_1,
-                                                                              desc="Calculating fingerprints")])
-    fingerprints_2 = np.array([get_fingerprint(spectrum) for spectrum in tqdm(list_of_smiles_2,
-                                                                              desc="Calculating fingerprints")])
+    """Returns a 2d ndarray containing the tanimoto scores between the smiles
+
+    The fingerprints are cached, so repeated calls with the same library
+    smiles only pay for the pairwise scoring, which runs as one matrix call.
+    """
+    fingerprints_1 = np.array([get_fingerprint_cached(spectrum) for spectrum in tqdm(list_of_smiles_1,
+                                                                                     desc="Calculating fingerprints")])
+    fingerprints_2 = np.array([get_fingerprint_cached(spectrum) for spectrum in tqdm(list_of_smiles_2,
+                                                                                     desc="Calculating fingerprints")])
     print("Calculating tanimoto scores")
     tanimoto_scores = jaccard_similarity_matrix(fingerprints_1, fingerprints_2)
     return tanimoto_scores
 
 
+@lru_cache(maxsize=2**16)
 def calculate_single_tanimoto_score(smiles_1: str,
                                     smiles_2: str) -> float:
-    """Returns the tanimoto score and a boolean showing if the spectra are exact matches"""
-    test_spectrum_fingerprint = get_fingerprint(smiles_1)
-    library_fingerprint = get_fingerprint(smiles_2)
+    """Returns the tanimoto score and a boolean showing if the spectra are exact matches
+
+    The scores are cached per smiles pair, since the benchmarking loops
+    score the same pairs repeatedly."""
+    test_spectrum_fingerprint = get_fingerprint_cached(smiles_1)
+    library_fingerprint = get_fingerprint_cached(smiles_2)
     tanimoto_score = float(jaccard_index(library_fingerprint, test_spectrum_fingerprint))
     return tanimoto_score
 
@@ -66,10 +86,12 @@ def select_inchi_for_unique_inchikeys(list_of_spectra: List[Spectrum]) -> (List[
         inchikeys_list.append(s.get("inchikey"))
         inchi_list.append(s.get("inchi"))
     inchi_array = np.array(inchi_list)
-    inchikeys14_array = np.array([x[:14] for x in inchikeys_list])
+    # Casting to U14 truncates all inchikeys to their first 14 characters in
+    # one vectorized pass, instead of slicing each string in Python
+    inchikeys14_array = np.array(inchikeys_list).astype("U14")
 
-    # Select unique inchikeys
-    inchikeys14_unique = sorted(list({x[:14] for x in inchikeys_list}))
+    # Select unique inchikeys, np.unique returns them sorted
+    inchikeys14_unique = np.unique(inchikeys14_array).tolist()
 
     spectra_with_most_frequent_inchi_per_unique_inchikey = []
     for inchikey14 in inchikeys14_unique:
@@ -89,12 +111,19 @@ def calculate_highest_tanimoto_score(query_spectra,
                                      nr_of_top_inchikeys):
     """Returns the highest scoring library spectra in """
     tanimoto_scores_df = calculate_tanimoto_scores_unique_inchikey(query_spectra, library_spectra)
-    unique_query_inchikeys = list(tanimoto_scores_df.index)
+    # The scores are read once as a numpy matrix and the top scores are
+    # selected per row with one argpartition call, instead of pandas label
+    # lookups per cell
+    tanimoto_scores_matrix = tanimoto_scores_df.to_numpy()
+    library_inchikeys = np.asarray(tanimoto_scores_df.columns)
+    indexes_highest_scores = np.argpartition(tanimoto_scores_matrix,
+                                             -nr_of_top_inchikeys,
+                                             axis=1)[:, -nr_of_top_inchikeys:]
     highest_score_dict = {}
-    for inchikey in unique_query_inchikeys:
-        tanimoto_scores = tanimoto_scores_df.loc[inchikey, :]
-        index_highest_scores = np.argpartition(tanimoto_scores, -nr_of_top_inchikeys)[-nr_of_top_inchikeys:]
+    for row_nr, inchikey in enumerate(tanimoto_scores_df.index):
+        tanimoto_scores = tanimoto_scores_matrix[row_nr]
+        index_highest_scores = indexes_highest_scores[row_nr]
         sorted_index_highest_scores = np.flip(index_highest_scores[np.argsort(tanimoto_scores[index_highest_scores])])
-        inchikey_and_highest_scores = [(tanimoto_scores_df.columns[i], tanimoto_scores[i]) for i in sorted_index_highest_scores]
+        inchikey_and_highest_scores = [(library_inchikeys[i], tanimoto_scores[i]) for i in sorted_index_highest_scores]
         highest_score_dict[inchikey] = inchikey_and_highest_scores
     return highest_score_dict
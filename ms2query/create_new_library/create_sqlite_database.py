@@ -3,6 +3,7 @@ This script is not needed for normally running MS2Query, it is only needed to ge
 new models
 """
 
+import json
 import sqlite3
 from typing import Dict, List
 import pandas as pd
@@ -150,15 +151,20 @@ def fill_spectrum_data_table(sqlite_file_name: str,
     add_spectrum_command = f"""INSERT INTO 'spectrum_data'
                            values ({value_placeholders[:-2]})"""
 
-    # Add the data of each spectrum to the sqlite table
+    # The rows for all spectra are prepared first and inserted with one
+    # executemany call in a single transaction, instead of one execute per
+    # spectrum
+    value_dicts = []
     for i, spectrum in tqdm(enumerate(list_of_spectra),
                             desc="Adding spectra to sqlite table",
                             disable=not progress_bar):
         metadata = spectrum.metadata
         spectrumid = i
 
-        # Give the value for the default columns
-        value_dict = {"metadata": str(metadata),
+        # Give the value for the default columns. The metadata is stored as
+        # json, which parses an order of magnitude faster than the python
+        # repr that older sqlite files stored.
+        value_dict = {"metadata": json.dumps(metadata, default=str),
                       "spectrumid": spectrumid}
 
         # Gets the data for addition columns from metadata
@@ -168,10 +174,10 @@ def fill_spectrum_data_table(sqlite_file_name: str,
                     value_dict[column] = str(metadata[column])
                 else:
                     value_dict[column] = ""
+        value_dicts.append(value_dict)
 
-        cur = conn.cursor()
-        cur.execute(add_spectrum_command, value_dict)
-
+    cur = conn.cursor()
+    cur.executemany(add_spectrum_command, value_dicts)
     conn.commit()
     conn.close()
 
@@ -11,11 +11,11 @@ import numpy as np
 import pandas as pd
 from gensim.models import Word2Vec
 from matchms.Spectrum import Spectrum
-from ms2deepscore import MS2DeepScore
 from ms2deepscore.models import load_model as load_ms2ds_model
-from spec2vec.vector_operations import calc_vector
 from tqdm import tqdm
-from ms2query.clean_and_filter_spectra import create_spectrum_documents
+from ms2query.clean_and_filter_spectra import (
+    calculate_ms2ds_embeddings_in_batches, calculate_s2v_embeddings_in_batches,
+    create_spectrum_documents)
 from ms2query.create_new_library.add_classifire_classifications import (
     convert_to_dataframe, select_compound_classes)
 from ms2query.create_new_library.create_sqlite_database import \
@@ -50,7 +50,9 @@ class LibraryFilesCreator:
                  output_directory: Union[str, Path],
                  s2v_model_file_name: str = None,
                  ms2ds_model_file_name: str = None,
-                 add_compound_classes: bool = True
+                 add_compound_classes: bool = True,
+                 *,
+                 spectrum_documents=None
                  ):
         """Creates files needed to run queries on a library
 
@@ -68,6 +70,11 @@ class LibraryFilesCreator:
             file name of a s2v model
         ms2ds_model_file_name:
             File name of a ms2ds model
+        spectrum_documents:
+            Already created SpectrumDocuments for the library spectra. When
+            given, creating the documents again for the s2v embeddings is
+            skipped. Tokenizing the peaks is not cheap, so this avoids doing
+            it twice when the documents were already built for training.
         """
         # pylint: disable=too-many-arguments
         self.progress_bars = True
@@ -98,6 +105,7 @@ class LibraryFilesCreator:
         self.list_of_spectra = [msfilters.default_filters(s) for s in tqdm(self.list_of_spectra,
                                                                            desc="Applying default filters to spectra")]
         self.add_compound_classes = add_compound_classes
+        self.spectrum_documents = spectrum_documents
 
     def _check_for_existing_files(self):
         assert not os.path.exists(self.sqlite_file_name), \
@@ -136,17 +144,19 @@ class LibraryFilesCreator:
 
         A dataframe with as index randomly generated spectrum indexes and as columns the indexes
         of the vector is converted to pickle.
+
+        The existence of the output files is already checked once in the
+        constructor, so no additional file system checks are done here.
         """
-        assert not os.path.exists(self.ms2ds_embeddings_file_name), \
-            "Given ms2ds_embeddings_file_name already exists"
         assert self.ms2ds_model is not None, "No MS2deepscore model was provided"
-        ms2ds = MS2DeepScore(self.ms2ds_model,
-                             progress_bar=self.progress_bars)
-
-        # Compute spectral embeddings
-        embeddings = ms2ds.calculate_vectors(self.list_of_spectra)
+        # Compute spectral embeddings with batched model calls
+        embeddings = calculate_ms2ds_embeddings_in_batches(self.ms2ds_model,
+                                                           self.list_of_spectra,
+                                                           progress_bar=self.progress_bars)
         spectrum_ids = np.arange(0, len(self.list_of_spectra))
-        all_embeddings_df = pd.DataFrame(embeddings, index=spectrum_ids)
+        # The embeddings are kept in float32, like the model outputs them,
+        # which halves the size of the pickled file
+        all_embeddings_df = pd.DataFrame(embeddings.astype(np.float32), index=spectrum_ids)
         all_embeddings_df.to_pickle(self.ms2ds_embeddings_file_name)
 
     def store_s2v_embeddings(self):
@@ -154,24 +164,25 @@ class LibraryFilesCreator:
 
         A dataframe with as index randomly generated spectrum indexes and as columns the indexes
         of the vector is converted to pickle.
+
+        The existence of the output files is already checked once in the
+        constructor, so no additional file system checks are done here.
         """
-        assert not os.path.exists(self.s2v_embeddings_file_name), \
-            "Given s2v_embeddings_file_name already exists"
         assert self.s2v_model is not None, "No spec2vec model was specified"
-        # Convert Spectrum objects to SpectrumDocument
-        spectrum_documents = create_spectrum_documents(
-            self.list_of_spectra,
-            progress_bar=self.progress_bars)
-        embeddings_dict = {}
-        for spectrum_id, spectrum_document in tqdm(enumerate(spectrum_documents),
-                                                   desc="Calculating embeddings",
-                                                   disable=not self.progress_bars):
-            embedding = calc_vector(self.s2v_model,
-                                    spectrum_document,
-                                    allowed_missing_percentage=100)
-            embeddings_dict[spectrum_id] = embedding
-
-        # Convert to pandas Dataframe
-        embeddings_dataframe = pd.DataFrame.from_dict(embeddings_dict,
-                                                      orient="index")
+        # Convert Spectrum objects to SpectrumDocument, unless precomputed
+        # documents were given
+        if self.spectrum_documents is not None:
+            assert len(self.spectrum_documents) == len(self.list_of_spectra), \
+                "The number of given spectrum documents does not match the number of spectra"
+            spectrum_documents = self.spectrum_documents
+        else:
+            spectrum_documents = create_spectrum_documents(
+                self.list_of_spectra,
+                progress_bar=self.progress_bars)
+        embeddings = calculate_s2v_embeddings_in_batches(self.s2v_model,
+                                                         spectrum_documents,
+                                                         progress_bar=self.progress_bars)
+
+        # Convert to pandas Dataframe, stored in float32 to halve the file size
+        embeddings_dataframe = pd.DataFrame(embeddings.astype(np.float32))
         embeddings_dataframe.to_pickle(self.s2v_embeddings_file_name)
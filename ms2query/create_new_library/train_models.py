@@ -57,9 +57,12 @@ def train_all_models(annotated_training_spectra,
                                )
 
     # Train Spec2Vec model
-    spectrum_documents = create_spectrum_documents(annotated_training_spectra + unannotated_training_spectra)
+    # The documents for the annotated spectra are built separately, so they
+    # can be reused when storing the library embeddings below
+    annotated_spectrum_documents = create_spectrum_documents(annotated_training_spectra)
+    unannotated_spectrum_documents = create_spectrum_documents(unannotated_training_spectra)
 
-    train_new_word2vec_model(spectrum_documents,
+    train_new_word2vec_model(annotated_spectrum_documents + unannotated_spectrum_documents,
                              iterations=settings.spec2vec_iterations,
                              filename=spec2vec_model_file_name,
                              workers=4,
@@ -78,7 +81,8 @@ def train_all_models(annotated_training_spectra,
                                                 output_folder,
                                                 spec2vec_model_file_name,
                                                 ms2deepscore_model_file_name,
-                                                add_compound_classes=settings.add_compound_classes)
+                                                add_compound_classes=settings.add_compound_classes,
+                                                spectrum_documents=annotated_spectrum_documents)
     library_files_creator.create_all_library_files()
 
 
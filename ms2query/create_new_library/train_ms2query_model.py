@@ -4,7 +4,7 @@ new models
 """
 
 import os
-from typing import List
+from typing import Dict, List
 import pandas as pd
 from matchms import Spectrum
 from onnxconverter_common import FloatTensorType
@@ -55,40 +55,67 @@ class DataCollectorForTraining():
         validation_query_spectra:
             List of Spectrum objects
         """
-        all_tanimoto_scores = pd.DataFrame()
-        info_of_matches_with_tanimoto = pd.DataFrame()
+        # The features are calculated per query first, so the smiles of all
+        # matches can be fetched from sqlite in one batched query instead of
+        # one metadata query per query spectrum
+        results_tables = []
+        all_match_spectrum_ids = set()
         for query_spectrum in tqdm(query_spectra,
-                                   desc="Get scores and tanimoto scores"):
+                                   desc="Calculating match features"):
             results_table = self.ms2library.calculate_features_single_spectrum(query_spectrum,
                                                                                self.preselection_cut_off)
-
+            results_tables.append((query_spectrum, results_table))
+            all_match_spectrum_ids.update(results_table.data.index)
+        metadata_of_matches = self.ms2library.sqlite_library.get_metadata_from_sqlite(
+            list(all_match_spectrum_ids))
+        smiles_of_matches = {spectrum_id: metadata["smiles"]
+                             for spectrum_id, metadata in metadata_of_matches.items()}
+
+        # The per query dataframes are collected in lists and concatenated
+        # once, since appending to a growing dataframe copies all earlier
+        # rows on every append
+        tanimoto_scores_per_query = []
+        matches_with_tanimoto_per_query = []
+        for query_spectrum, results_table in tqdm(results_tables,
+                                                  desc="Get scores and tanimoto scores"):
             # Get tanimoto scores
             library_spectrum_ids = list(results_table.data.index)
             tanimoto_scores = calculate_tanimoto_scores_with_library(self.ms2library.sqlite_library, query_spectrum,
-                                                                     library_spectrum_ids)
+                                                                     library_spectrum_ids,
+                                                                     smiles_of_spectra=smiles_of_matches)
             # Add tanimoto scores for training data
-            all_tanimoto_scores = \
-                all_tanimoto_scores.append(tanimoto_scores,
-                                           ignore_index=True)
+            tanimoto_scores_per_query.append(tanimoto_scores)
             # Select the features (remove inchikey, since this should not be
             # used for training
             features_dataframe = results_table.get_training_data()
             # Add matches for which a tanimoto score could be calculated
-            matches_with_tanimoto = features_dataframe.loc[
-                tanimoto_scores.index]
-            info_of_matches_with_tanimoto = \
-                info_of_matches_with_tanimoto.append(matches_with_tanimoto,
-                                                     ignore_index=True)
+            matches_with_tanimoto_per_query.append(
+                features_dataframe.loc[tanimoto_scores.index])
+        all_tanimoto_scores = pd.concat(tanimoto_scores_per_query,
+                                        ignore_index=True)
+        info_of_matches_with_tanimoto = pd.concat(matches_with_tanimoto_per_query,
+                                                  ignore_index=True)
         return info_of_matches_with_tanimoto, all_tanimoto_scores
 
 
 def calculate_tanimoto_scores_with_library(sqlite_library: SqliteLibrary,
                                            query_spectrum: Spectrum,
-                                           spectra_ids_list: List[int]):
-    # Get inchikeys belonging to spectra ids
-    metadata_dict = sqlite_library.get_metadata_from_sqlite(
-        spectra_ids_list)
-    library_smiles_list = [metadata_dict[spectrum_id]["smiles"] for spectrum_id in spectra_ids_list]
+                                           spectra_ids_list: List[int],
+                                           smiles_of_spectra: Dict[int, str] = None):
+    """Returns the tanimoto scores between the query spectrum and the library spectra
+
+    smiles_of_spectra:
+        The smiles per library spectrum id, when they were already fetched in
+        a batched sqlite query. Default = None, which means the smiles are
+        queried from the sqlite library.
+    """
+    # Get smiles belonging to spectra ids
+    if smiles_of_spectra is None:
+        metadata_dict = sqlite_library.get_metadata_from_sqlite(
+            spectra_ids_list)
+        smiles_of_spectra = {spectrum_id: metadata["smiles"]
+                             for spectrum_id, metadata in metadata_dict.items()}
+    library_smiles_list = [smiles_of_spectra[spectrum_id] for spectrum_id in spectra_ids_list]
     tanimoto_scores = calculate_tanimoto_scores_from_smiles(library_smiles_list, [query_spectrum.get("smiles")])
     tanimoto_df = pd.DataFrame(tanimoto_scores, index=spectra_ids_list, columns=["Tanimoto_score"])
     return tanimoto_df
@@ -1,4 +1,6 @@
+import hashlib
 import os.path
+from collections import OrderedDict
 from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
 import numpy as np
 import pandas as pd
@@ -9,14 +11,15 @@ from ms2deepscore.models import load_model as load_ms2ds_model
 from onnxruntime import InferenceSession
 from spec2vec.vector_operations import calc_vector, cosine_similarity_matrix
 from tqdm import tqdm
-from ms2query.clean_and_filter_spectra import (clean_metadata,
-                                               create_spectrum_documents,
-                                               normalize_and_filter_peaks)
+from ms2query.clean_and_filter_spectra import (
+    calculate_ms2ds_embeddings_in_batches, calculate_s2v_embeddings_in_batches,
+    clean_metadata, create_spectrum_documents, normalize_and_filter_peaks)
 from ms2query.query_from_sqlite_database import SqliteLibrary
 from ms2query.results_table import ResultsTable
 from ms2query.utils import (SettingsRunMS2Query, column_names_for_output,
                             load_ms2query_model, load_pickled_file,
-                            predict_onnx_model, return_non_existing_file_name,
+                            normalize_embeddings, predict_onnx_model,
+                            return_non_existing_file_name,
                             select_files_in_directory)
 
 
@@ -87,8 +90,15 @@ class MS2Library:
         assert self.ms2ds_model.base.output_shape[1] == self.ms2ds_embeddings.shape[1], \
             "Dimension of pre-computed MS2DeepScore embeddings does not fit given model."
 
-        # load precursor mz's
-        self.precursors_library = self.sqlite_library.get_precursor_mz()
+        # The library embeddings are normalized once in float32, so each query
+        # only needs a single matrix product instead of recomputing the
+        # library norms on every call
+        self.ms2ds_embeddings_normalized = load_normalized_embeddings(
+            self.ms2ds_embeddings, pickled_ms2ds_embeddings_file_name)
+
+        # load precursor mz's, stored as a series so the precursors for the
+        # preselected spectra can be gathered with one vectorized lookup
+        self.precursors_library = pd.Series(self.sqlite_library.get_precursor_mz())
 
         assert self.ms2ds_embeddings.shape[0] == self.s2v_embeddings.shape[0], \
             "The number ms2deepscore embeddings is not equal to the number of spectra with s2v embeddings"
@@ -100,11 +110,35 @@ class MS2Library:
         self.ionization_mode = self.sqlite_library.get_ionization_mode_library()
         self.spectra_of_inchikey14s, self.closely_related_inchikey14s = \
             self.sqlite_library.get_inchikey_information()
-        self.inchikey14s_of_spectra = {}
-        for inchikey, list_of_spectrum_ids in \
-                self.spectra_of_inchikey14s.items():
-            for spectrum_id in list_of_spectrum_ids:
-                self.inchikey14s_of_spectra[spectrum_id] = inchikey
+        # The closest related inchikeys and their average tanimoto score only
+        # depend on the library, so they are split out of the (inchikey,
+        # score) tuples once instead of per query
+        self.closely_related_inchikey14s_names = {
+            inchikey: [related_inchikey for related_inchikey, _ in related_scores]
+            for inchikey, related_scores in self.closely_related_inchikey14s.items()}
+        self.average_tanimoto_of_closely_related_inchikey14s = {
+            inchikey: sum(tanimoto_score for _, tanimoto_score in related_scores) / len(related_scores)
+            for inchikey, related_scores in self.closely_related_inchikey14s.items()}
+        # Stored as a series, so the inchikeys for the preselected spectra
+        # can be gathered with one vectorized lookup per query
+        self.inchikey14s_of_spectra = pd.Series(
+            {spectrum_id: inchikey
+             for inchikey, list_of_spectrum_ids in self.spectra_of_inchikey14s.items()
+             for spectrum_id in list_of_spectrum_ids})
+        # Each library spectrum is also mapped to an integer code for its
+        # inchikey, so summing scores per inchikey becomes one segmented sum
+        # over the codes instead of a pandas groupby per query
+        inchikey14_codes, unique_inchikey14s = pd.factorize(self.inchikey14s_of_spectra)
+        self._inchikey14_codes_of_spectra = pd.Series(inchikey14_codes,
+                                                      index=self.inchikey14s_of_spectra.index)
+        self._number_of_unique_inchikey14s = len(unique_inchikey14s)
+        self._code_of_inchikey14 = {inchikey14: code
+                                    for code, inchikey14 in enumerate(unique_inchikey14s)}
+        # Bounded cache with the normalized ms2ds embedding per query
+        # spectrum, keyed by the peaks, so re-running overlapping query
+        # batches skips the model forward pass
+        self._ms2ds_query_embedding_cache = OrderedDict()
+        self._max_cached_query_embeddings = 2 ** 14
 
     def calculate_features_single_spectrum(self,
                                            query_spectrum: Spectrum,
@@ -115,7 +149,28 @@ class MS2Library:
         query_spectrum = normalize_and_filter_peaks(query_spectrum)
         if query_spectrum is None:
             return None
-
+        return self._calculate_features_cleaned_spectrum(query_spectrum,
+                                                         preselection_cut_off,
+                                                         filter_on_ionmode)
+
+    def _calculate_features_cleaned_spectrum(self,
+                                             query_spectrum: Spectrum,
+                                             preselection_cut_off: int,
+                                             filter_on_ionmode: Optional[str],
+                                             query_s2v_embedding: Optional[np.ndarray] = None,
+                                             query_ms2ds_embedding: Optional[np.ndarray] = None
+                                             ) -> Optional[ResultsTable]:
+        """Calculates a results table for an already cleaned spectrum
+
+        query_s2v_embedding:
+            The s2v embedding of the query spectrum, when it was already
+            computed in a batched call. Default = None, which means the
+            embedding is computed when the s2v scores are calculated.
+        query_ms2ds_embedding:
+            The normalized ms2ds embedding of the query spectrum, when it was
+            already computed in a batched call. Default = None, which means
+            the embedding is computed when the ms2ds scores are calculated.
+        """
         # Check if the ionization mode matches that of the library
         query_ionmode = query_spectrum.get("ionmode")
         if filter_on_ionmode is not None:
@@ -128,12 +183,14 @@ class MS2Library:
                 f"The spectrum is in {query_ionmode} ionization mode, while the library is for {self.ionization_mode} ionization mode. " \
                 f"Check the readme to download a library in the {query_ionmode} ionization mode"
 
-        ms2deepscore_scores = self._get_all_ms2ds_scores(query_spectrum)
+        ms2deepscore_scores = self._get_all_ms2ds_scores(query_spectrum,
+                                                         query_ms2ds_embedding)
         # Initialize result table
         results_table = ResultsTable(preselection_cut_off=preselection_cut_off, ms2deepscores=ms2deepscore_scores,
                                      query_spectrum=query_spectrum, sqlite_library=self.sqlite_library)
         results_table = \
-            self._calculate_features_for_random_forest_model(results_table)
+            self._calculate_features_for_random_forest_model(results_table,
+                                                             query_s2v_embedding)
         return results_table
 
     def analog_search_yield_df(self,
@@ -160,14 +217,35 @@ class MS2Library:
         assert self.ms2query_model is not None, \
             "MS2Query model should be given when creating ms2library object"
 
+        # The spectra are cleaned before the loop, so the s2v embeddings of
+        # all query spectra can be computed in one batched call instead of
+        # one calc_vector call per query inside the loop
+        cleaned_query_spectra = []
+        for i, query_spectrum in enumerate(query_spectra):
+            query_spectrum.set("spectrum_nr", i + 1)
+            query_spectrum = clean_metadata(query_spectrum)
+            cleaned_query_spectra.append(normalize_and_filter_peaks(query_spectrum))
+        spectra_passing_cleaning = [spectrum for spectrum in cleaned_query_spectra
+                                    if spectrum is not None]
+        query_documents = create_spectrum_documents(spectra_passing_cleaning)
+        s2v_query_embeddings = calculate_s2v_embeddings_in_batches(
+            self.s2v_model, query_documents, progress_bar=False)
+        ms2ds_query_embeddings = self._batch_ms2ds_query_embeddings(spectra_passing_cleaning)
+
+        embedding_row = 0
         for i, query_spectrum in \
-                tqdm(enumerate(query_spectra),
+                tqdm(enumerate(cleaned_query_spectra),
                      desc="Predicting matches for query spectra",
                      disable=not progress_bar,
-                     total=len(query_spectra)):
-            query_spectrum.set("spectrum_nr", i+1)
-            results_table = self.calculate_features_single_spectrum(query_spectrum, settings.preselection_cut_off,
-                                                                    settings.filter_on_ion_mode)
+                     total=len(cleaned_query_spectra)):
+            results_table = None
+            if query_spectrum is not None:
+                results_table = self._calculate_features_cleaned_spectrum(
+                    query_spectrum, settings.preselection_cut_off,
+                    settings.filter_on_ion_mode,
+                    s2v_query_embeddings[embedding_row],
+                    ms2ds_query_embeddings[embedding_row])
+                embedding_row += 1
             if results_table is None:
                 print(f"Spectrum nr {i} was not stored, since it did not pass all cleaning steps")
             else:
@@ -179,6 +257,34 @@ class MS2Library:
                     additional_ms2query_score_columns=settings.additional_ms2query_score_columns)
                 yield results_df
 
+    def analog_search_return_df(self,
+                                query_spectra: List[Spectrum],
+                                settings: Optional[SettingsRunMS2Query] = None,
+                                progress_bar: bool = True
+                                ) -> pd.DataFrame:
+        """Runs ms2query on the query_spectra and returns the results in one dataframe
+
+        Args
+        ----
+        query_spectra:
+            List of query spectra for which the best matches should be found
+        settings:
+            Settings for running MS2Query, see SettingsRunMS2Query for details.
+        progress_bar:
+            If true a progress bar is shown.
+        """
+        if settings is None:
+            settings = SettingsRunMS2Query()
+        results_dfs = [results_df for results_df
+                       in self.analog_search_yield_df(query_spectra, settings, progress_bar)
+                       if results_df is not None]
+        if len(results_dfs) == 0:
+            # Return an empty dataframe with the expected columns
+            return pd.DataFrame(columns=column_names_for_output(
+                True, self.sqlite_library.contains_class_annotation(),
+                settings.additional_metadata_columns, settings.additional_ms2query_score_columns))
+        return pd.concat(results_dfs, ignore_index=True)
+
     def analog_search_store_in_csv(self,
                                    query_spectra: List[Spectrum],
                                    results_csv_file_location: str,
@@ -210,11 +316,25 @@ class MS2Library:
 
         results_df_generator = self.analog_search_yield_df(query_spectra, settings)
 
+        # The results are buffered and appended in chunks, since appending
+        # each result separately reopens the file for every query spectrum
+        buffer_size = 1024
+        buffered_results = []
         for results_df in results_df_generator:
-            results_df.to_csv(results_csv_file_location, mode="a", header=False, float_format="%.4f", index=False)
+            if results_df is None:
+                continue
+            buffered_results.append(results_df)
+            if len(buffered_results) >= buffer_size:
+                pd.concat(buffered_results).to_csv(results_csv_file_location, mode="a",
+                                                   header=False, float_format="%.4f", index=False)
+                buffered_results = []
+        if len(buffered_results) > 0:
+            pd.concat(buffered_results).to_csv(results_csv_file_location, mode="a",
+                                               header=False, float_format="%.4f", index=False)
 
     def _calculate_features_for_random_forest_model(self,
-                                                    results_table: ResultsTable
+                                                    results_table: ResultsTable,
+                                                    query_s2v_embedding: Optional[np.ndarray] = None
                                                     ) -> ResultsTable:
         """Calculate the features for random forest model for selected spectra
 
@@ -222,6 +342,9 @@ class MS2Library:
         ------
         results_table:
             ResultsTable object for which no scores have been selected yet.
+        query_s2v_embedding:
+            The s2v embedding of the query spectrum, when it was already
+            computed in a batched call. Default = None.
         """
         # Select the library spectra that have the highest MS2Deepscore
         results_table.preselect_on_ms2deepscore()
@@ -232,16 +355,15 @@ class MS2Library:
 
         results_table.data["s2v_score"] = self._get_s2v_scores(
             results_table.query_spectrum,
-            results_table.data.index.values)
+            results_table.data.index.values,
+            query_s2v_embedding)
 
-        precursors = np.array(
-            [self.precursors_library[x]
-             for x in results_table.data.index])
-        results_table.add_precursors(
-            precursors)
+        precursors = self.precursors_library.loc[results_table.data.index].to_numpy()
+        results_table.add_precursors(precursors)
         return results_table
 
-    def _get_all_ms2ds_scores(self, query_spectrum: Spectrum
+    def _get_all_ms2ds_scores(self, query_spectrum: Spectrum,
+                              query_ms2ds_embedding: Optional[np.ndarray] = None
                               ) -> pd.Series:
         """Returns a dataframe with the ms2deepscore similarity scores
 
@@ -251,16 +373,76 @@ class MS2Library:
         query_spectra
             Spectrum for which similarity scores should be calculated for all
             spectra in the ms2ds embeddings file.
+        query_ms2ds_embedding:
+            The normalized ms2ds embedding of the query spectrum, when it was
+            already computed in a batched call. Default = None.
+        """
+        if query_ms2ds_embedding is not None:
+            query_embeddings = query_ms2ds_embedding
+        else:
+            query_embeddings = self._get_ms2ds_query_embedding(query_spectrum)
+        # Both sides are normalized, so the cosine scores are one matrix
+        # product. The scores are returned in float64 like before. The single
+        # score column is wrapped in a series directly, which skips building
+        # an intermediate DataFrame just to select its first column.
+        ms2ds_scores = (self.ms2ds_embeddings_normalized @ query_embeddings.T).astype(np.float64)
+        return pd.Series(ms2ds_scores[:, 0], index=self.ms2ds_embeddings.index)
+
+    @staticmethod
+    def _ms2ds_embedding_cache_key(query_spectrum: Spectrum) -> bytes:
+        """Returns the embedding cache key, a hash of the peaks"""
+        return hashlib.blake2b(
+            query_spectrum.peaks.mz.tobytes() + query_spectrum.peaks.intensities.tobytes(),
+            digest_size=16).digest()
+
+    def _cache_ms2ds_query_embedding(self, cache_key: bytes,
+                                     query_embedding: np.ndarray):
+        """Stores the embedding in the cache, evicting the oldest entry when full"""
+        if len(self._ms2ds_query_embedding_cache) >= self._max_cached_query_embeddings:
+            self._ms2ds_query_embedding_cache.popitem(last=False)
+        self._ms2ds_query_embedding_cache[cache_key] = query_embedding
+
+    def _batch_ms2ds_query_embeddings(self, query_spectra: List[Spectrum]
+                                      ) -> List[np.ndarray]:
+        """Returns the normalized ms2ds embedding for each query spectrum
+
+        The ms2ds model is run in one batched predict, instead of one keras
+        call per query spectrum. Only spectra whose embedding is not cached
+        yet are computed; the results are added to the cache, so the
+        embedding cache works for batched runs as well.
         """
+        uncached_spectra = {}
+        for query_spectrum in query_spectra:
+            cache_key = self._ms2ds_embedding_cache_key(query_spectrum)
+            if cache_key not in self._ms2ds_query_embedding_cache:
+                uncached_spectra[cache_key] = query_spectrum
+        if len(uncached_spectra) > 0:
+            new_embeddings = normalize_embeddings(
+                calculate_ms2ds_embeddings_in_batches(
+                    self.ms2ds_model, list(uncached_spectra.values()),
+                    progress_bar=False).astype(np.float32))
+            for row, cache_key in enumerate(uncached_spectra):
+                self._cache_ms2ds_query_embedding(cache_key,
+                                                  new_embeddings[row:row + 1])
+        return [self._get_ms2ds_query_embedding(query_spectrum)
+                for query_spectrum in query_spectra]
+
+    def _get_ms2ds_query_embedding(self, query_spectrum: Spectrum) -> np.ndarray:
+        """Returns the normalized ms2ds embedding of the query spectrum
+
+        The embeddings are cached keyed by a hash of the peaks, so the model
+        forward pass only runs once per distinct spectrum when overlapping
+        query batches are analyzed repeatedly.
+        """
+        cache_key = self._ms2ds_embedding_cache_key(query_spectrum)
+        if cache_key in self._ms2ds_query_embedding_cache:
+            self._ms2ds_query_embedding_cache.move_to_end(cache_key)
+            return self._ms2ds_query_embedding_cache[cache_key]
         ms2ds = MS2DeepScore(self.ms2ds_model, progress_bar=False)
-        query_embeddings = ms2ds.calculate_vectors([query_spectrum])
-        library_ms2ds_embeddings_numpy = self.ms2ds_embeddings.to_numpy()
-        ms2ds_scores = cosine_similarity_matrix(library_ms2ds_embeddings_numpy,
-                                                query_embeddings)
-        similarity_matrix_dataframe = pd.DataFrame(
-            ms2ds_scores,
-            index=self.ms2ds_embeddings.index)
-        return similarity_matrix_dataframe.iloc[:, 0]
+        query_embedding = normalize_embeddings(
+            ms2ds.calculate_vectors([query_spectrum]).astype(np.float32))
+        self._cache_ms2ds_query_embedding(cache_key, query_embedding)
+        return query_embedding
 
     def _calculate_average_ms2deepscore_multiple_library_spectra(
             self,
@@ -274,7 +456,7 @@ class MS2Library:
         selected_spectrum_ids = list(results_table.data["spectrum_ids"])
         ms2ds_scores = results_table.ms2deepscores
         selected_inchikeys = \
-            [self.inchikey14s_of_spectra[x] for x in selected_spectrum_ids]
+            self.inchikey14s_of_spectra.loc[selected_spectrum_ids].tolist()
         # Populate results table
         results_table.data["inchikey"] = selected_inchikeys
         selected_inchikeys_set = set(selected_inchikeys)
@@ -283,7 +465,7 @@ class MS2Library:
         selected_closely_related_inchikeys = []
         for inchikey in selected_inchikeys_set:
             selected_closely_related_inchikeys += \
-                [scores[0] for scores in self.closely_related_inchikey14s[inchikey]]
+                self.closely_related_inchikey14s_names[inchikey]
 
         inchikeys_to_calc_average_for = \
             set(selected_closely_related_inchikeys)
@@ -312,16 +494,20 @@ class MS2Library:
         inchikey14s:
             Set of inchikeys to average over.
         """
-        average_ms2ds_per_inchikey14 = {}
-        for inchikey14 in inchikey14s:
-            sum_of_ms2ds_scores = 0
-            for spectrum_id in self.spectra_of_inchikey14s[inchikey14]:
-                sum_of_ms2ds_scores += ms2ds_scores.loc[spectrum_id]
-            nr_of_spectra = len(self.spectra_of_inchikey14s[inchikey14])
-            if nr_of_spectra > 0:
-                avg_ms2ds_score = sum_of_ms2ds_scores / nr_of_spectra
-                average_ms2ds_per_inchikey14[inchikey14] = avg_ms2ds_score
-        return average_ms2ds_per_inchikey14
+        # The scores are summed per inchikey with one segmented sum over the
+        # precomputed inchikey codes, which is the aggregation matrix product
+        # written as two bincount calls instead of a pandas groupby
+        inchikey14_codes = \
+            self._inchikey14_codes_of_spectra.loc[ms2ds_scores.index].to_numpy()
+        summed_scores = np.bincount(inchikey14_codes,
+                                    weights=ms2ds_scores.to_numpy(),
+                                    minlength=self._number_of_unique_inchikey14s)
+        spectra_per_inchikey14 = np.bincount(inchikey14_codes,
+                                             minlength=self._number_of_unique_inchikey14s)
+        return {inchikey14:
+                summed_scores[self._code_of_inchikey14[inchikey14]] /
+                spectra_per_inchikey14[self._code_of_inchikey14[inchikey14]]
+                for inchikey14 in inchikey14s}
 
     def _calculate_average_multiple_library_structures(
             self,
@@ -340,14 +526,12 @@ class MS2Library:
         """
         results_per_inchikey = {}
         for inchikey in selected_inchikey14s:
-            # For each inchikey a list with the top 10 closest related inchikeys
-            #  and the corresponding tanimoto score is stored
-            closest_library_structures_and_tanimoto_scores = \
-                self.closely_related_inchikey14s[inchikey]
-            closest_library_structures = [tuple[0] for tuple in closest_library_structures_and_tanimoto_scores]
-            tanimoto_scores = [tuple[1] for tuple in closest_library_structures_and_tanimoto_scores]
-
-            average_tanimoto_score_multiple_library_spectra = sum(tanimoto_scores) / len(tanimoto_scores)
+            # For each inchikey the top 10 closest related inchikeys were
+            # selected at library creation; their names and average tanimoto
+            # score are precomputed in __init__
+            closest_library_structures = self.closely_related_inchikey14s_names[inchikey]
+            average_tanimoto_score_multiple_library_spectra = \
+                self.average_tanimoto_of_closely_related_inchikey14s[inchikey]
             sum_of_average_ms2ds_multiple_library_structures = \
                 sum(average_inchikey_scores[closely_related_inchikey14] for closely_related_inchikey14 in closest_library_structures)
             average_ms2deepscore_multiple_library_structures = sum_of_average_ms2ds_multiple_library_structures/ len(closest_library_structures)
@@ -356,7 +540,8 @@ class MS2Library:
 
     def _get_s2v_scores(self,
                         query_spectrum: Spectrum,
-                        preselection_of_library_ids: List[int]
+                        preselection_of_library_ids: List[int],
+                        query_s2v_embedding: Optional[np.ndarray] = None
                         ) -> np.ndarray:
         """Returns the s2v scores
 
@@ -364,16 +549,24 @@ class MS2Library:
             Spectrum object
         preselection_of_library_ids:
             list of spectrum ids for which the s2v scores should be calculated
+        query_s2v_embedding:
+            The s2v embedding of the query spectrum, when it was already
+            computed in a batched call. Default = None.
             """
-        query_spectrum_document = \
-            create_spectrum_documents([query_spectrum])[0]
-        query_s2v_embedding = calc_vector(self.s2v_model,
-                                          query_spectrum_document,
-                                          allowed_missing_percentage=100)
-        preselected_s2v_embeddings = \
-            self.s2v_embeddings.loc[preselection_of_library_ids].to_numpy()
-        s2v_scores = cosine_similarity_matrix(np.array([query_s2v_embedding]),
-                                              preselected_s2v_embeddings)[0]
+        if query_s2v_embedding is None:
+            query_spectrum_document = \
+                create_spectrum_documents([query_spectrum])[0]
+            query_s2v_embedding = calc_vector(self.s2v_model,
+                                              query_spectrum_document,
+                                              allowed_missing_percentage=100)
+        # Both sides are passed as contiguous float32, matching the dtype the
+        # library embeddings are stored in, so no upcasted copy is made
+        # inside the cosine kernel
+        preselected_s2v_embeddings = np.ascontiguousarray(
+            self.s2v_embeddings.loc[preselection_of_library_ids].to_numpy(dtype=np.float32))
+        s2v_scores = cosine_similarity_matrix(
+            np.asarray([query_s2v_embedding], dtype=np.float32),
+            preselected_s2v_embeddings)[0]
         # todo convert to dataframe, so there is less chance of introducing
         #  errors
         return s2v_scores
@@ -389,13 +582,40 @@ def get_ms2query_model_prediction_single_spectrum(
     ms2query_model_file_name:
         File name of a hdf5 name containing the ms2query model.
     """
-    # .values removes feature names, since this will cause a warning since the model was trained without feature names.
-    current_query_matches_info = result_table.get_training_data().copy().values
+    # to_numpy removes feature names, since these would cause a warning since the model was trained without feature names.
+    # get_training_data already returns a new projection, so no extra copy is made here.
+    current_query_matches_info = result_table.get_training_data().to_numpy()
     predictions = predict_onnx_model(random_forest_onnx_model, current_query_matches_info)
     result_table.add_ms2query_meta_score(predictions)
     return result_table
 
 
+def load_normalized_embeddings(embeddings: pd.DataFrame,
+                               pickled_embeddings_file_name: str) -> np.ndarray:
+    """Returns the library embeddings normalized per row as a float32 matrix
+
+    The normalized matrix is stored in a .npy file next to the pickled
+    embeddings the first time a library is loaded. Later runs load this file
+    memory-mapped, which skips the normalization pass and lets the operating
+    system share the pages between processes.
+    """
+    normalized_file_name = pickled_embeddings_file_name + ".norm.npy"
+    if os.path.exists(normalized_file_name) and \
+            os.path.getmtime(normalized_file_name) >= os.path.getmtime(pickled_embeddings_file_name):
+        normalized_embeddings = np.load(normalized_file_name, mmap_mode="r")
+        if normalized_embeddings.shape == embeddings.shape:
+            return normalized_embeddings
+    normalized_embeddings = np.ascontiguousarray(
+        normalize_embeddings(embeddings.to_numpy().astype(np.float32)))
+    try:
+        np.save(normalized_file_name, normalized_embeddings)
+    except OSError:
+        # The library directory is not always writable, in that case the
+        # normalized embeddings are only kept in memory
+        pass
+    return normalized_embeddings
+
+
 def select_files_for_ms2query(file_names: List[str], files_to_select=None):
     """Selects the files needed for MS2Library based on their file extensions. """
     dict_with_file_extensions = \
@@ -1,4 +1,3 @@
-import ast
 import io
 import os
 import sqlite3
@@ -7,6 +6,7 @@ import numpy as np
 import pandas as pd
 from matchms.Spectrum import Spectrum
 from tqdm import tqdm
+from ms2query.query_from_sqlite_database import _parse_metadata
 from ms2query.utils import load_pickled_file
 
 
@@ -56,7 +56,9 @@ def get_spectra_from_sqlite(sqlite_file_name: str,
                        disable=not progress_bar):
         peaks = result[0]
         intensities = result[1]
-        metadata = ast.literal_eval(result[2])
+        # Metadata in new sqlite files is parsed with the fast json parser,
+        # the python repr in old files falls back to ast.literal_eval
+        metadata = _parse_metadata(result[2])
         spectrum_id = metadata[spectrum_id_storage_name]
         spectra_dict[spectrum_id] = Spectrum(mz=peaks,
                                              intensities=intensities,
@@ -3,13 +3,43 @@ Functions to obtain data from sqlite files.
 """
 
 import ast
+import json
 import os.path
 import sqlite3
+from functools import lru_cache
 from typing import Dict, List, Tuple
 import pandas as pd
 from ms2query.utils import column_names_for_output
 
 
+@lru_cache(maxsize=None)
+def _sqlite_connection(sqlite_file_name: str) -> sqlite3.Connection:
+    """Returns a shared read connection for the sqlite file
+
+    Reusing one connection avoids paying the connect and statement parse
+    cost on every call. The pragmas keep temporary data in memory and let
+    sqlite read the file through mmap instead of separate read calls.
+    """
+    connection = sqlite3.connect(sqlite_file_name, check_same_thread=False)
+    connection.execute("PRAGMA temp_store=MEMORY")
+    connection.execute("PRAGMA mmap_size=268435456")
+    return connection
+
+
+def _parse_metadata(metadata: str) -> dict:
+    """Parses a metadata blob from a sqlite file
+
+    New sqlite files store the metadata as json, which is parsed by the
+    C json parser. Older sqlite files stored the python repr of the dict,
+    which can only be parsed by the much slower ast.literal_eval, so this
+    is kept as fallback for backwards compatibility.
+    """
+    try:
+        return json.loads(metadata)
+    except ValueError:
+        return ast.literal_eval(metadata)
+
+
 class SqliteLibrary:
     def __init__(self,
                  sqlite_file_name,
@@ -44,19 +74,22 @@ class SqliteLibrary:
             The name of the table in the sqlite file in which the metadata is
             stored. Default = "spectrum_data"
         """
-        conn = sqlite3.connect(self.sqlite_file_name)
-        sqlite_command = \
-            f"""SELECT {spectrum_id_storage_name}, metadata FROM {table_name} 
-            WHERE {spectrum_id_storage_name} 
-            IN ('{"', '".join(map(str, spectrum_id_list))}')"""
+        conn = _sqlite_connection(self.sqlite_file_name)
         cur = conn.cursor()
-        cur.execute(sqlite_command)
-        list_of_metadata = cur.fetchall()
-        # Convert to dictionary
         results_dict = {}
-        for spectrumid, metadata in list_of_metadata:
-            metadata = ast.literal_eval(metadata)
-            results_dict[spectrumid] = metadata
+        # The spectrum ids are queried in chunks of 900, since sqlite does not
+        # allow more than SQLITE_MAX_VARIABLE_NUMBER (999) parameters per query.
+        max_nr_of_parameters = 900
+        for chunk_start in range(0, len(spectrum_id_list), max_nr_of_parameters):
+            chunk = spectrum_id_list[chunk_start:chunk_start + max_nr_of_parameters]
+            sqlite_command = \
+                f"""SELECT {spectrum_id_storage_name}, metadata FROM {table_name}
+                WHERE {spectrum_id_storage_name}
+                IN ({",".join("?" * len(chunk))})"""
+            cur.execute(sqlite_command, list(map(str, chunk)))
+            # Convert to dictionary
+            for spectrumid, metadata in cur.fetchall():
+                results_dict[spectrumid] = _parse_metadata(metadata)
         # Check if all spectrum_ids were found
         for spectrum_id in spectrum_id_list:
             assert spectrum_id in results_dict, \
@@ -64,23 +97,28 @@ class SqliteLibrary:
         return results_dict
 
     def get_ionization_mode_library(self):
-        conn = sqlite3.connect(self.sqlite_file_name)
+        conn = _sqlite_connection(self.sqlite_file_name)
         sqlite_command = "SELECT metadata FROM spectrum_data"
         cur = conn.cursor()
         cur.execute(sqlite_command)
+        # The rows are pulled in batches with fetchmany instead of one
+        # fetchone call into the sqlite3 layer per row, while still stopping
+        # early once the ionization mode is found.
+        cur.arraysize = 256
         while True:
-            metadata = cur.fetchone()
-            # If all values have been checked None is returned.
-            if metadata is None:
+            rows = cur.fetchmany()
+            # If all values have been checked an empty list is returned.
+            if not rows:
                 print("The ionization mode of the library could not be determined")
                 return None
-            metadata = ast.literal_eval(metadata[0])
-            if "ionmode" in metadata:
-                ionmode = metadata["ionmode"]
-                if ionmode == "positive":
-                    return "positive"
-                if ionmode == "negative":
-                    return "negative"
+            for row in rows:
+                metadata = _parse_metadata(row[0])
+                if "ionmode" in metadata:
+                    ionmode = metadata["ionmode"]
+                    if ionmode == "positive":
+                        return "positive"
+                    if ionmode == "negative":
+                        return "negative"
 
     def get_precursor_mz(self,
                         ) -> Dict[str, float]:
@@ -97,15 +135,14 @@ class SqliteLibrary:
             The name of the table in the sqlite file in which the metadata is
             stored. Default = "spectrum_data"
         """
-        conn = sqlite3.connect(self.sqlite_file_name)
+        conn = _sqlite_connection(self.sqlite_file_name)
         sqlite_command = \
             f"SELECT {self.spectrum_id_storage_name}, precursor_mz FROM spectrum_data"
         cur = conn.cursor()
         cur.execute(sqlite_command)
-        results = cur.fetchall()
-        precursor_mz_dict = {}
-        for result in results:
-            precursor_mz_dict[result[0]] = result[1]
+        # The rows are (spectrum_id, precursor_mz) pairs, so the dict can be
+        # built directly from the cursor without a Python loop
+        precursor_mz_dict = dict(cur.fetchall())
         return precursor_mz_dict
 
 
@@ -116,7 +153,7 @@ class SqliteLibrary:
         sqlite_file_name:
             The file name of an sqlite file
         """
-        conn = sqlite3.connect(self.sqlite_file_name)
+        conn = _sqlite_connection(self.sqlite_file_name)
         sqlite_command = "SELECT * FROM inchikeys"
         cur = conn.cursor()
         cur.execute(sqlite_command)
@@ -134,21 +171,28 @@ class SqliteLibrary:
     def get_classes_inchikeys(self,
                               inchikeys):
         assert self.contains_class_annotation(), "The sqlite library given does not contain compound class information"
-        conn = sqlite3.connect(self.sqlite_file_name)
+        conn = _sqlite_connection(self.sqlite_file_name)
         column_names = column_names_for_output(return_non_classifier_columns=False,
                                                return_classifier_columns=True)
-        sqlite_command = f"""SELECT inchikey, {", ".join(column_names)} 
-        FROM inchikeys WHERE inchikey IN ('{"', '".join(map(str, inchikeys))}')"""
         cur = conn.cursor()
-        cur.execute(sqlite_command)
-        results = cur.fetchall()
+        results = []
+        # The inchikeys are queried in chunks of 900, since sqlite does not
+        # allow more than SQLITE_MAX_VARIABLE_NUMBER (999) parameters per query.
+        max_nr_of_parameters = 900
+        inchikeys = list(inchikeys)
+        for chunk_start in range(0, len(inchikeys), max_nr_of_parameters):
+            chunk = inchikeys[chunk_start:chunk_start + max_nr_of_parameters]
+            sqlite_command = f"""SELECT inchikey, {", ".join(column_names)}
+            FROM inchikeys WHERE inchikey IN ({",".join("?" * len(chunk))})"""
+            cur.execute(sqlite_command, list(map(str, chunk)))
+            results.extend(cur.fetchall())
         assert len(results) == len(inchikeys), "Not all inchikeys were found in the sqlite library"
         dataframe_results = pd.DataFrame(results,
                                          columns=["inchikey"] + column_names)
         return dataframe_results
 
     def contains_class_annotation(self) -> bool:
-        conn = sqlite3.connect(self.sqlite_file_name)
+        conn = _sqlite_connection(self.sqlite_file_name)
         sqlite_command = "PRAGMA table_info(inchikeys)"
         cur = conn.cursor()
         cur.execute(sqlite_command)
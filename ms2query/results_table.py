@@ -56,11 +56,14 @@ class ResultsTable:
         self.data = self.data.set_index(column_name)
 
     def add_related_inchikey_scores(self, related_inchikey_scores):
-
+        # Map the scores per unique inchikey onto the rows in one vectorized
+        # pass, instead of looping over the rows in Python
         self.data["average_ms2deepscore_multiple_library_structures"] = \
-            [related_inchikey_scores[x][0] for x in self.data["inchikey"]]
+            self.data["inchikey"].map({inchikey: scores[0]
+                                       for inchikey, scores in related_inchikey_scores.items()})
         self.data["average_tanimoto_score_library_structures"] = \
-            [related_inchikey_scores[x][1] for x in self.data["inchikey"]]
+            self.data["inchikey"].map({inchikey: scores[1]
+                                       for inchikey, scores in related_inchikey_scores.items()})
 
     def add_precursors(self, precursors):
         assert isinstance(precursors, np.ndarray), "Expected np.ndarray as input."
@@ -68,11 +71,16 @@ class ResultsTable:
         self.data["precursor_mz_difference"] = np.abs(precursors - self.precursor_mz)
 
     def preselect_on_ms2deepscore(self):
-        selected_spectrum_ids = list(self.ms2deepscores.nlargest(
-            self.preselection_cut_off).index)
-        self.data["spectrum_ids"] = pd.Series(selected_spectrum_ids)
-        self.data["ms2ds_score"] = \
-            np.array(self.ms2deepscores.loc[selected_spectrum_ids])
+        # Only the top scoring spectra are needed, so the cut off highest
+        # scores are selected with argpartition in O(n) and only those are
+        # sorted, instead of ranking the entire score series
+        scores = self.ms2deepscores.to_numpy()
+        cut_off = min(self.preselection_cut_off, len(scores))
+        highest_indexes = np.sort(np.argpartition(scores, -cut_off)[-cut_off:])
+        # The stable sort keeps ties in spectrum id order, like nlargest did
+        highest_indexes = highest_indexes[np.argsort(-scores[highest_indexes], kind="stable")]
+        self.data["spectrum_ids"] = pd.Series(self.ms2deepscores.index.to_numpy()[highest_indexes])
+        self.data["ms2ds_score"] = scores[highest_indexes]
 
     def add_ms2query_meta_score(self,
                                 predictions):
@@ -131,14 +139,14 @@ class ResultsTable:
         if selected_analogs.empty:
             return None
 
-        # For each analog the compound name is selected from sqlite
-        metadata_dict = self.sqlite_library.get_metadata_from_sqlite(list(selected_analogs["spectrum_ids"]))
+        # For each analog the compound name and smiles are selected from
+        # sqlite in one batched query and gathered in a single pass
+        metadata_dict = self.sqlite_library.get_metadata_from_sqlite(
+            list(selected_analogs["spectrum_ids"]))
         compound_name_list = [metadata_dict[analog_spectrum_id]["compound_name"]
-                              for analog_spectrum_id
-                              in list(selected_analogs["spectrum_ids"])]
+                              for analog_spectrum_id in selected_analogs["spectrum_ids"]]
         smiles_list = [metadata_dict[analog_spectrum_id]["smiles"]
-                       for analog_spectrum_id
-                       in list(selected_analogs["spectrum_ids"])]
+                       for analog_spectrum_id in selected_analogs["spectrum_ids"]]
 
         # Add inchikey and ms2query model prediction to results df
         # results_df = selected_analogs.loc[:, ["spectrum_ids", "ms2query_model_prediction", "inchikey"]]
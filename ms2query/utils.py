@@ -14,6 +14,17 @@ else:
     import pickle
 
 
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Returns the embeddings scaled to unit length per row
+
+    After normalizing once, the cosine similarity is a plain dot product,
+    so the norms do not have to be recomputed for every library query pair.
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
 def load_ms2query_model(ms2query_model_file_name) -> InferenceSession:
     """Loads in a MS2Query model
 
@@ -33,8 +33,10 @@ def test_store_ms2ds_embeddings(tmp_path, path_to_general_test_files,
         "Expected file to be created"
     # Test if correct embeddings are stored
     embeddings = load_pickled_file(new_embeddings_file_name)
+    # The embeddings are stored in float32, while the expected file is float64
     pd.testing.assert_frame_equal(embeddings, expected_ms2ds_embeddings,
                                   check_exact=False,
+                                  check_dtype=False,
                                   atol=1e-5)
 
 
@@ -52,8 +54,10 @@ def test_store_s2v_embeddings(tmp_path, path_to_general_test_files, hundred_test
     assert os.path.isfile(new_embeddings_file_name), \
         "Expected file to be created"
     embeddings = load_pickled_file(new_embeddings_file_name)
+    # The embeddings are stored in float32, while the expected file is float64
     pd.testing.assert_frame_equal(embeddings, expected_s2v_embeddings,
                                   check_exact=False,
+                                  check_dtype=False,
                                   atol=1e-5)
 
 